@@ -15,13 +15,24 @@ http://www-scf.usc.edu/~boqinggo/domainadaptation.html#gfk_section
 
 import bob.io.base
 import numpy
-import numpy.matlib
 import scipy.linalg
 
 import logging
+import numbers
 
 logger = logging.getLogger("bob.learn.linear")
 
+# Extra random directions and power iterations of the randomized PCA
+_RSVD_OVERSAMPLING = 10
+_RSVD_POWER_ITERATIONS = 4
+
+
+def _fortran_dot(a, b):
+    """
+    Computes the product of `a` and `b` laid out in Fortran order, as LAPACK expects, at no extra cost
+    """
+    return numpy.dot(b.T, a.T).T
+
 
 def null_space(A, eps=1e-20):
     """
@@ -29,12 +40,48 @@ def null_space(A, eps=1e-20):
     The left null space of A is the orthogonal complement to the column space of A.
 
     """
-    U, S, V = scipy.linalg.svd(A)
+    # A complete QR of A^T splits the space into the row space of A (leading columns of Q)
+    # and its orthogonal complement (trailing columns); pivoting exposes the rank on the diagonal of R.
+    # A^T usually is a view of some machine weights, so it is not overwritten
+    Q, R, _ = scipy.linalg.qr(A.T, pivoting=True, check_finite=False)
+    rank = numpy.sum(numpy.abs(numpy.diagonal(R)) > eps)
+
+    return Q[:, rank:]
+
+
+def _gfk_inner_factor(theta):
+    """
+    Computes the Cholesky factor of the GFK inner matrix [B1, B2; B3, B4] (Equation (6)) from the principal angles.
+
+    B1, B2 = B3 and B4 are diagonal and the inner matrix is PSD, so the factor is closed-form,
+    L = [diag(l1), 0; diag(l2), diag(l4)], and is computed in place on a few dim-sized buffers.
+    The sin(x) / x terms go through :py:func:`numpy.sinc`, which has the right limit for theta = 0.
+
+    **Returns**
+      (l1, l2, l4): The diagonals of the blocks of L
+    """
+    # sin(2 theta) / (2 theta)
+    sinc_2t = numpy.sinc(theta * (2 / numpy.pi))
+
+    # l1 = sqrt(b1), with b1 = 0.5 * (1 + sin(2 theta) / (2 theta))
+    l1 = 1 + sinc_2t
+    l1 *= 0.5
+    numpy.sqrt(l1, out=l1)
+
+    # l2 = b2 / l1, with b2 = 0.5 * (cos(2 theta) - 1) / (2 theta) = -0.5 * sin(theta) * sin(theta) / theta
+    l2 = numpy.sinc(theta * (1 / numpy.pi))
+    l2 *= numpy.sin(theta)
+    l2 *= -0.5
+    l2 /= l1
+
+    # l4 = sqrt(b4 - l2^2), with b4 = 0.5 * (1 - sin(2 theta) / (2 theta))
+    l4 = 1 - sinc_2t
+    l4 *= 0.5
+    l4 -= l2 * l2
+    numpy.maximum(l4, 0, out=l4)
+    numpy.sqrt(l4, out=l4)
 
-    padding = max(0, numpy.shape(A)[1] - numpy.shape(S)[0])
-    null_mask = numpy.concatenate(((S <= eps), numpy.ones((padding,), dtype=bool)), axis=0)
-    null_s = scipy.compress(null_mask, V, axis=0)
-    return scipy.transpose(null_s)
+    return l1, l2, l4
 
 
 class GFKMachine(object):
@@ -59,6 +106,46 @@ class GFKMachine(object):
         if isinstance(hdf5, bob.io.base.HDF5File):
             self.load(hdf5)
 
+    @property
+    def L(self):
+        """
+        The factor :math:`L` of the GFK kernel, :math:`G = L L^T`, in single precision
+
+        This is what the trainer produces, what is stored and what scoring uses
+        """
+        return self._L
+
+    @L.setter
+    def L(self, value):
+        self._L = None if value is None else numpy.asfortranarray(value, dtype=numpy.float32)
+        self._G = None
+
+    @property
+    def G(self):
+        """
+        The GFK kernel matrix
+
+        Only its factor :math:`L` is kept; the dense matrix is computed from it on first access
+        """
+        if self._G is None and self._L is not None:
+            # SYRK only computes the upper triangle
+            self._G = scipy.linalg.blas.dsyrk(1.0, self._L)
+            self._G += numpy.triu(self._G, 1).T
+        return self._G
+
+    @G.setter
+    def G(self, value):
+        # A dense kernel (positive semidefinite), e.g. from a machine saved with it, is factored as G = L * L',
+        # keeping the numerically non-zero eigenvalues only
+        if value is None:
+            self.L = None
+        else:
+            # value is kept as the dense kernel, so it is not overwritten
+            w, U = scipy.linalg.eigh(numpy.asarray(value, dtype=numpy.float64), check_finite=False)
+            mask = w > w.max() * w.shape[0] * numpy.finfo(w.dtype).eps
+            self.L = U[:, mask] * numpy.sqrt(w[mask])
+        self._G = value
+
     def load(self, hdf5):
         """
         Loads the machine from the given HDF5 file
@@ -79,12 +166,18 @@ class GFKMachine(object):
         hdf5.cd("target_machine")
         self.target_machine = bob.learn.linear.Machine(hdf5)
         hdf5.cd("..")
-        self.G = hdf5.get("G")
+        if hdf5.has_key("L"):
+            self.L = hdf5.get("L")
+        else:
+            # machines saved with the dense kernel
+            self.G = hdf5.get("G")
 
     def save(self, hdf5):
         """
         Saves the machine to the given HDF5 file
 
+        The kernel is stored as its factor :math:`L` (key ``L``), as computed by the trainer
+
         **Parameters**
 
           hdf5: :py:class:`bob.io.base.HDF5File`
@@ -99,7 +192,8 @@ class GFKMachine(object):
         hdf5.cd("target_machine")
         self.target_machine.save(hdf5)
         hdf5.cd("..")
-        hdf5.set("G", self.G)
+        # only the (single precision) factor of the kernel is stored
+        hdf5.set("L", self.L)
 
     def shape(self):
         """
@@ -108,7 +202,7 @@ class GFKMachine(object):
         **Returns**
          (int, int) <– The size of the weights matrix
         """
-        return self.G.shape
+        return (self._L.shape[0], self._L.shape[0])
 
     def compute_principal_angles(self):
         """
@@ -121,8 +215,9 @@ class GFKMachine(object):
         Pt = self.target_machine.weights
 
         # S = cos(theta_1, theta_2, ..., theta_n)
-        _, S, _ = numpy.linalg.svd(numpy.dot(Ps.T, Pt))
-        thetas_squared = numpy.arccos(S) ** 2
+        S = scipy.linalg.svd(_fortran_dot(Ps.T, Pt), compute_uv=False, overwrite_a=True, check_finite=False, lapack_driver='gesdd')
+        # rounding may push the cosines slightly above 1
+        thetas_squared = numpy.arccos(numpy.clip(S, -1.0, 1.0)) ** 2
 
         return numpy.sum(thetas_squared)
 
@@ -145,10 +240,43 @@ class GFKMachine(object):
 
         return 1 - numpy.linalg.det(numpy.dot(Y1.T, Y2)) ** 2
 
+    def score_batch(self, source_domain_data, target_domain_data):
+        """
+        Compute the dot products in the infinity space using the trainer Kernel (G) between all pairs of source and target samples
+
+        The products are computed in single precision with the factor :math:`L` of :math:`G = L L^T`, cached whenever G is set
+
+        **Parameters**
+          source_domain_data: :py:func:`numpy.array`
+            Data from the source domain, one sample per row
+
+          target_domain_data: :py:func:`numpy.array`
+            Data from the target domain, one sample per row
+
+        **Returns**
+          scores: :py:func:`numpy.array`
+            The matrix of products, one row per source sample and one column per target sample
+        """
+        # normalize in double precision (one buffer per domain), as the centering needs the digits;
+        # only the normalized data goes to single precision, so that the products below run in SGEMM.
+        # A multiplication by the (feature-sized) reciprocal is cheaper than dividing every sample
+        source_domain_data = numpy.subtract(source_domain_data, self.source_machine.input_subtract, dtype=numpy.float64)
+        numpy.multiply(source_domain_data, numpy.reciprocal(self.source_machine.input_divide), out=source_domain_data)
+        source_domain_data = source_domain_data.astype(numpy.float32, copy=False)
+        target_domain_data = numpy.subtract(target_domain_data, self.target_machine.input_subtract, dtype=numpy.float64)
+        numpy.multiply(target_domain_data, numpy.reciprocal(self.target_machine.input_divide), out=target_domain_data)
+        target_domain_data = target_domain_data.astype(numpy.float32, copy=False)
+
+        # x' * G * y = x' * L * L' * y, in the cheapest order for the number of samples and the rank of L;
+        # with many samples on both sides, that is (x' * L) * (y' * L)'
+        return numpy.linalg.multi_dot([source_domain_data, self._L, self._L.T, target_domain_data.T])
+
     def __call__(self, source_domain_data, target_domain_data):
         """
         Compute dot product in the infinity space using the trainer Kernel (G)
 
+        Only the products of the first source sample are returned; use :py:meth:`score_batch` to score all pairs at once
+
         **Parameters**
           source_domain_data: :py:func:`numpy.array`
             Data from the source domain
@@ -156,12 +284,7 @@ class GFKMachine(object):
           target_domain_data: :py:func:`numpy.array`
             Data from the target domain
         """
-        source_domain_data = (
-                             source_domain_data - self.source_machine.input_subtract) / self.source_machine.input_divide
-        target_domain_data = (
-                             target_domain_data - self.target_machine.input_subtract) / self.target_machine.input_divide
-
-        return numpy.dot(numpy.dot(source_domain_data, self.G), target_domain_data.T)[0]
+        return self.score_batch(source_domain_data, target_domain_data)[0]
 
 
 class GFKTrainer(object):
@@ -198,7 +321,7 @@ class GFKTrainer(object):
 
     **Constructor Documentation:**
 
-       - **bob.learn.linear.GFKTrainer** (number_of_subspaces, subspace_dim_source, subspace_dim_target, eps)
+       - **bob.learn.linear.GFKTrainer** (number_of_subspaces, subspace_dim_source, subspace_dim_target, eps, randomized_pca)
 
         **Parameters**
 
@@ -214,9 +337,14 @@ class GFKTrainer(object):
           eps: `float`
             Floor value
 
+          randomized_pca: `bool`
+            Compute the PCA subspaces with a randomized SVD, when the number of dimensions kept is given as an `int` much smaller than the data.
+            This is faster, but only approximates the subspaces, and only well when the spectrum of the data decays.
+
     """
 
-    def __init__(self, number_of_subspaces=-1, subspace_dim_source=0.99, subspace_dim_target=0.99, eps=1e-20):
+    def __init__(self, number_of_subspaces=-1, subspace_dim_source=0.99, subspace_dim_target=0.99, eps=1e-20,
+                 randomized_pca=False):
         """
         Constructor
 
@@ -233,11 +361,15 @@ class GFKTrainer(object):
 
           eps: `float`
             Floor value
+
+          randomized_pca: `bool`
+            Compute the PCA subspaces with a randomized SVD, when applicable
         """
         self.m_number_of_subspaces = number_of_subspaces
         self.m_subspace_dim_source = subspace_dim_source
         self.m_subspace_dim_target = subspace_dim_target
         self.eps = eps
+        self.m_randomized_pca = randomized_pca
 
 
     def get_best_d(self, Ps, Pt, Pst):
@@ -254,7 +386,7 @@ class GFKTrainer(object):
           Pst: Source + Target subspace        
         """
         def compute_angles(A, B):
-            _, S, _ = numpy.linalg.svd(numpy.dot(A.T, B))
+            S = scipy.linalg.svd(_fortran_dot(A.T, B), compute_uv=False, overwrite_a=True, check_finite=False, lapack_driver='gesdd')
             S[numpy.where(numpy.isclose(S ,1, atol=self.eps)==True)[0]] = 1
             return numpy.arccos(S)
 
@@ -320,84 +452,82 @@ class GFKTrainer(object):
             self.m_number_of_subspaces = self.get_best_d(Pst.weights, Ps.weights, Pt.weights)
             logger.info("  -> Best m_number_of_subspaces is {0}".format(self.m_number_of_subspaces))
 
-        G = self._train_gfk(numpy.hstack((Ps.weights, null_space(Ps.weights.T))),
+        L = self._train_gfk(numpy.hstack((Ps.weights, null_space(Ps.weights.T))),
                             Pt.weights[:, 0:self.m_number_of_subspaces])
 
         machine = GFKMachine()
         machine.source_machine = Ps
         machine.target_machine = Pt
-        machine.G = G
+        machine.L = L
 
         return machine
 
     def _train_gfk(self, Ps, Pt):
         """
+        Computes the GFK kernel between the source basis `Ps` (completed to the whole space) and the target basis `Pt`
+
+        **Returns**
+          L: :py:func:`numpy.array`
+            The factor of the kernel, :math:`G = L L^T`
         """
 
-        N = Ps.shape[1]
         dim = Pt.shape[1]
 
         # Principal angles between subspaces
         QPt = numpy.dot(Ps.T, Pt)
 
         # [V1,V2,V,Gam,Sig] = gsvd(QPt(1:dim,:), QPt(dim+1:end,:));
-        A = QPt[0:dim, :].copy()
-        B = QPt[dim:, :].copy()
+        # A goes to LAPACK, which then works in place on this Fortran-ordered copy;
+        # B is only used in a product, so a view of the C-contiguous QPt is enough
+        A = numpy.asfortranarray(QPt[:dim])
+        B = QPt[dim:]
 
         # Equation (2)
-        [V1, V2, V, Gam, Sig] = bob.math.gsvd(A, B)
+        # The columns of QPt are orthonormal, so the GSVD reduces to a CS decomposition: from the SVD
+        # A = V1 * Gam * V', the columns of B * V are orthogonal with norms Sig and normalize to V2
+        V1, gam, Vt = scipy.linalg.svd(A, lapack_driver='gesdd', overwrite_a=True, check_finite=False)
+        V2 = numpy.dot(B, Vt.T)
+        sig = numpy.sqrt(numpy.einsum('ij,ij->j', V2, V2))
+        # (columns of shared directions only hold round-off, but their weights below vanish with their angle)
+        numpy.divide(V2, sig, out=V2, where=sig > 0)
         V2 = -V2
 
-        # Some sanity checks with the GSVD
-        I = numpy.eye(V1.shape[1])
-        I_check = numpy.dot(Gam.T, Gam) + numpy.dot(Sig.T, Sig)
-        assert numpy.sum(abs(I - I_check)) < 1e-10
+        # Some sanity checks with the GSVD, only when debugging
+        if __debug__ and logger.isEnabledFor(logging.DEBUG):
+            assert numpy.allclose(gam ** 2 + sig ** 2, 1.0, atol=1e-10)
 
-        theta = numpy.arccos(numpy.diagonal(Gam))
-
-        # Equation (6)
-        B1 = numpy.diag(0.5 * (1 + (numpy.sin(2 * theta) / (2. * numpy.maximum
-        (theta, self.eps)))))
-        B2 = numpy.diag(0.5 * ((numpy.cos(2 * theta) - 1) / (2 * numpy.maximum(
-            theta, self.eps))))
-        B3 = B2
-        B4 = numpy.diag(0.5 * (1 - (numpy.sin(2 * theta) / (2. * numpy.maximum
-        (theta, self.eps)))))
+        # Equation (6); the angles come from both the cosines and the sines, since arccos(gam) alone
+        # is inaccurate (and needs clipping) for the small angles of shared directions
+        l1, l2, l4 = _gfk_inner_factor(numpy.arctan2(sig, gam))
 
         # Equation (9) of the suplementary matetial
-        delta1_1 = numpy.hstack((V1, numpy.zeros(shape=(dim, N - dim))))
-        delta1_2 = numpy.hstack((numpy.zeros(shape=(N - dim, dim)), V2))
-        delta1 = numpy.vstack((delta1_1, delta1_2))
+        # G = Ps * [V1, 0; 0, V2] * [B1, B2, 0; B3, B4, 0; 0, 0, 0] * [V1, 0; 0, V2]' * Ps'
+        # Only the first `dim` columns of V2 meet a non-zero block (and only those are computed above),
+        # so the N x N factors collapse into the N x 2dim basis Omega = [Omega1, Omega2] and the 2dim x 2dim inner matrix
+        Omega1 = numpy.dot(Ps[:, :dim], V1)
+        Omega2 = numpy.dot(Ps[:, dim:], V2)
 
-        delta2_1 = numpy.hstack((B1, B2, numpy.zeros(shape=(dim, N - 2 * dim))))
-        delta2_2 = numpy.hstack((B3, B4, numpy.zeros(shape=(dim, N - 2 * dim))))
-        delta2_3 = numpy.zeros(shape=(N - 2 * dim, N))
-        delta2 = numpy.vstack((delta2_1, delta2_2, delta2_3))
+        # With the inner matrix factored as L * L', G = T * T' with T = Omega * L;
+        # the dense kernel is never formed here
+        return numpy.hstack((Omega1 * l1 + Omega2 * l2, Omega2 * l4))
 
-        delta3_1 = numpy.hstack((V1, numpy.zeros(shape=(dim, N - dim))))
-        delta3_2 = numpy.hstack((numpy.zeros(shape=(N - dim, dim)), V2))
-        delta3 = numpy.vstack((delta3_1, delta3_2)).T
+    def _train_pca(self, data, mu_data, std_data, subspace_dim):
 
-        delta = numpy.dot(numpy.dot(delta1, delta2), delta3)
-        G = numpy.dot(numpy.dot(Ps, delta), Ps.T)
+        if self.m_randomized_pca and isinstance(subspace_dim, numbers.Integral) and 2 * (subspace_dim + _RSVD_OVERSAMPLING) < min(data.shape):
+            # Only a few leading directions are kept, a randomized SVD approximates them without the full decomposition
+            machine = bob.learn.linear.Machine(self._randomized_pca(data, subspace_dim))
+        else:
+            t = bob.learn.linear.PCATrainer()
+            machine, variances = t.train(data)
 
-        return G
+            # For re-shaping, we need to copy...
+            variances = variances.copy()
 
-    def _train_pca(self, data, mu_data, std_data, subspace_dim):
-        t = bob.learn.linear.PCATrainer()
-        machine, variances = t.train(data)
-
-        # For re-shaping, we need to copy...
-        variances = variances.copy()
-
-        # compute variance percentage, if desired
-        if isinstance(subspace_dim, float):
-            cummulated = numpy.cumsum(variances) / numpy.sum(variances)
-            for index in range(len(cummulated)):
-                if cummulated[index] > subspace_dim:
-                    subspace_dim = index
-                    break
-            subspace_dim = index
+            # compute variance percentage, if desired
+            if isinstance(subspace_dim, float):
+                cummulated = numpy.cumsum(variances) / numpy.sum(variances)
+                # first index exceeding the requested energy, or the last one if none does
+                subspace_dim = min(int(numpy.searchsorted(cummulated, subspace_dim, side='right')), len(cummulated) - 1)
         logger.info("    ... Keeping %d PCA dimensions", subspace_dim)
 
         machine.resize(machine.shape[0], subspace_dim)
@@ -406,14 +536,45 @@ class GFKTrainer(object):
 
         return machine
 
+    def _randomized_pca(self, data, subspace_dim):
+        """
+        Computes the `subspace_dim` leading principal directions of `data` with a randomized SVD
+
+        Halko, Nathan, et al. "Finding structure with randomness: Probabilistic algorithms for constructing approximate matrix decompositions." SIAM review 53.2 (2011).
+
+        **Returns**
+          weights: :py:func:`numpy.array`
+            The principal directions, one per column
+        """
+        data = data - numpy.mean(data, axis=0)
+
+        # Orthonormal basis of the range of data, sharpened with a few power iterations
+        # (a fixed seed keeps the training deterministic and leaves the global random state alone)
+        omega = numpy.random.RandomState(0).normal(size=(data.shape[1], subspace_dim + _RSVD_OVERSAMPLING))
+        Q, _ = scipy.linalg.qr(_fortran_dot(data, omega), mode='economic', overwrite_a=True, check_finite=False)
+        for _ in range(_RSVD_POWER_ITERATIONS):
+            Q, _ = scipy.linalg.qr(_fortran_dot(data.T, Q), mode='economic', overwrite_a=True, check_finite=False)
+            Q, _ = scipy.linalg.qr(_fortran_dot(data, Q), mode='economic', overwrite_a=True, check_finite=False)
+
+        # SVD of the small projected matrix
+        _, _, Vt = scipy.linalg.svd(_fortran_dot(Q.T, data), full_matrices=False, overwrite_a=True, check_finite=False,
+                                   lapack_driver='gesdd')
+
+        return numpy.ascontiguousarray(Vt[:subspace_dim].T)
+
     def _znorm(self, data):
         """
-        Z-Normaliza
+        Z-Normaliza, in place
+
+        `data` is centered first, so that the standard deviation is computed from the centered values
         """
 
-        mu = numpy.average(data, axis=0)
-        std = numpy.std(data, axis=0)
+        n = data.shape[0]
+        mu = data.sum(axis=0) / n
+        numpy.subtract(data, mu, out=data)
 
-        data = (data - mu) / std
+        std = numpy.sqrt(numpy.einsum('ij,ij->j', data, data) / n)
+        numpy.maximum(std, self.eps, out=std)
+        numpy.divide(data, std, out=data)
 
         return data, mu, std
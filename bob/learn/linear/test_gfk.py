@@ -21,11 +21,11 @@ def compute_accuracy(K, Xs, Ys, Xt, Yt):
 
     source = numpy.diag(numpy.dot(numpy.dot(Xs, K), Xs.T))
     source = numpy.reshape(source, (Xs.shape[0], 1))
-    source = numpy.matlib.repmat(source, 1, Yt.shape[0])
+    source = numpy.tile(source, (1, Yt.shape[0]))
 
     target = numpy.diag(numpy.dot(numpy.dot(Xt, K), Xt.T))
     target = numpy.reshape(target, (Xt.shape[0], 1))
-    target = numpy.matlib.repmat(target, 1, Ys.shape[0]).T
+    target = numpy.tile(target, (1, Ys.shape[0])).T
 
     dist = source + target - 2 * numpy.dot(numpy.dot(Xs, K), Xt.T)
 
@@ -160,6 +160,8 @@ def test_load_save():
     # Training in random data
     gfk_trainer = GFKTrainer(10,  subspace_dim_source=1.0, subspace_dim_target=1.0)
     gfk_machine = gfk_trainer.train(train_source_data, train_target_data)
+    G = gfk_machine.G
+    L = gfk_machine.L
 
     hdf5_file = "gkf.hdf5"
     hdf5 = bob.io.base.HDF5File(hdf5_file, 'w')
@@ -171,6 +173,10 @@ def test_load_save():
     gfk_machine = GFKMachine(hdf5)
     os.remove(hdf5_file)
 
+    # The factor computed by the trainer is stored as is, and the kernel is rebuilt from it
+    assert numpy.array_equal(gfk_machine.L, L)
+    assert numpy.allclose(gfk_machine.G, G)
+
     # All the distances are smaller than 1
     products = gfk_machine(test_source_data, test_target_data)
     assert sum(products < 1) == 10
@@ -182,3 +188,180 @@ def test_load_save():
     reference = 2.4674011002723324
     assert abs(gfk_machine.compute_principal_angles()-reference) < 0.00001
     assert abs(gfk_machine.compute_binetcouchy_distance() - 0) < 0.00001
+
+
+def test_null_space():
+    """
+
+    Testing the null space basis
+    """
+    import numpy
+    from bob.learn.linear.GFK import null_space
+    numpy.random.seed(10)
+
+    A = numpy.random.normal(0, 1, size=(3, 10))
+    N = null_space(A)
+
+    assert N.shape == (10, 7)
+    assert numpy.allclose(numpy.dot(A, N), 0)
+    assert numpy.allclose(numpy.dot(N.T, N), numpy.eye(7))
+
+    # Rank deficient input
+    A[2] = A[0] + A[1]
+    assert null_space(A, eps=1e-10).shape == (10, 8)
+
+
+def test_score_batch():
+    """
+
+    Testing the scoring of all pairs at once
+    """
+    import numpy
+    numpy.random.seed(10)
+
+    train_source_data = numpy.random.normal(0, 1, size=(100, 4))
+    train_target_data = numpy.random.normal(2, 1, size=(100, 4))
+
+    test_source_data = numpy.random.normal(0, 1, size=(5, 4))
+    test_target_data = numpy.random.normal(2, 1, size=(10, 4))
+
+    gfk_trainer = GFKTrainer(2,  subspace_dim_source=1.0, subspace_dim_target=1.0)
+    gfk_machine = gfk_trainer.train(train_source_data, train_target_data)
+
+    scores = gfk_machine.score_batch(test_source_data, test_target_data)
+    assert scores.shape == (5, 10)
+
+    # Same products as the explicit kernel, up to single precision
+    Xs = (test_source_data - gfk_machine.source_machine.input_subtract) / gfk_machine.source_machine.input_divide
+    Xt = (test_target_data - gfk_machine.target_machine.input_subtract) / gfk_machine.target_machine.input_divide
+    assert numpy.allclose(scores, numpy.dot(numpy.dot(Xs, gfk_machine.G), Xt.T), atol=1e-5)
+
+    # A call scores the first source sample
+    assert numpy.allclose(gfk_machine(test_source_data, test_target_data), scores[0])
+
+    # Changes of the normalization are taken into account
+    gfk_machine.source_machine.input_divide = gfk_machine.source_machine.input_divide * 2
+    assert numpy.allclose(gfk_machine.score_batch(test_source_data, test_target_data), scores / 2, atol=1e-5)
+
+    # Features with a large mean offset are centered before going to single precision
+    offset = 1e8
+    gfk_machine = gfk_trainer.train(train_source_data + offset, train_target_data + offset)
+    scores = gfk_machine.score_batch(test_source_data + offset, test_target_data + offset)
+    Xs = (test_source_data + offset - gfk_machine.source_machine.input_subtract) / gfk_machine.source_machine.input_divide
+    Xt = (test_target_data + offset - gfk_machine.target_machine.input_subtract) / gfk_machine.target_machine.input_divide
+    assert numpy.allclose(scores, numpy.dot(numpy.dot(Xs, gfk_machine.G), Xt.T), atol=1e-5)
+
+
+def test_trainer_randomized_pca():
+    """
+
+    Testing the training with few PCA dimensions (randomized SVD)
+    """
+    import numpy
+    numpy.random.seed(10)
+
+    # decaying spectrum
+    def generate(size, mean):
+        rotation = numpy.linalg.qr(numpy.random.normal(0, 1, size=(60, 60)))[0]
+        return mean + numpy.dot(numpy.random.normal(0, 1, size=(size, 60)) * numpy.logspace(0, -3, 60), rotation)
+
+    train_source_data = generate(200, 0)
+    train_target_data = generate(200, 2)
+
+    gfk_trainer = GFKTrainer(5, subspace_dim_source=10, subspace_dim_target=10, randomized_pca=True)
+    gfk_machine = gfk_trainer.train(train_source_data, train_target_data)
+
+    assert gfk_machine.shape() == (60, 60)
+    for machine in (gfk_machine.source_machine, gfk_machine.target_machine):
+        assert machine.shape == (60, 10)
+        assert numpy.allclose(numpy.dot(machine.weights.T, machine.weights), numpy.eye(10))
+
+    # Same subspace as the PCATrainer
+    weights = gfk_trainer._randomized_pca(train_source_data, 10)
+    machine, _ = bob.learn.linear.PCATrainer().train(train_source_data)
+    assert _subspace_distance(weights, machine.weights[:, :10]) < 1e-3
+
+    # numpy integers take the randomized path too
+    calls = []
+    gfk_trainer = GFKTrainer(2, numpy.int64(3), numpy.int64(3), randomized_pca=True)
+    randomized_pca = gfk_trainer._randomized_pca
+    gfk_trainer._randomized_pca = lambda data, subspace_dim: calls.append(subspace_dim) or randomized_pca(data, subspace_dim)
+    gfk_machine = gfk_trainer.train(train_source_data, train_target_data)
+    assert calls == [3, 3]
+    assert gfk_machine.source_machine.shape == (60, 3)
+
+    # The randomized SVD is opt-in
+    gfk_trainer = GFKTrainer(5, subspace_dim_source=10, subspace_dim_target=10)
+    assert not gfk_trainer.m_randomized_pca
+
+
+def _gfk_integral(Ps, Pt, n_points=60):
+    """
+    Reference kernel, integrating phi(t) * phi(t)' along the geodesic from Ps[:, :dim] to Pt with a Gauss-Legendre quadrature
+    """
+    import numpy
+    dim = Pt.shape[1]
+    Xs = Ps[:, :dim]
+
+    U, c, Wt = numpy.linalg.svd(numpy.dot(Xs.T, Pt))
+    Y = numpy.dot(Pt, Wt.T) - numpy.dot(Xs, U) * c
+    s = numpy.linalg.norm(Y, axis=0)
+    Q = numpy.zeros_like(Y)
+    Q[:, s > 1e-12] = Y[:, s > 1e-12] / s[s > 1e-12]
+    theta = numpy.arctan2(s, c)
+
+    G = numpy.zeros((Ps.shape[0], Ps.shape[0]))
+    x, w = numpy.polynomial.legendre.leggauss(n_points)
+    for t, weight in zip((x + 1) / 2, w / 2):
+        phi = numpy.dot(Xs, U) * numpy.cos(t * theta) + Q * numpy.sin(t * theta)
+        G += weight * numpy.dot(phi, phi.T)
+    return G
+
+
+def test_train_gfk_integral():
+    """
+
+    Testing the kernel against the integral along the geodesic flow, also for overlapping subspaces
+    """
+    import numpy
+    numpy.random.seed(10)
+
+    def orthonormal(D, d):
+        return numpy.linalg.qr(numpy.random.normal(0, 1, size=(D, d)))[0]
+
+    gfk_trainer = GFKTrainer()
+    for D, dim, overlap in ((20, 5, 5), (30, 8, 8), (20, 5, 2), (10, 6, 0), (30, 5, 0)):
+        Ps = orthonormal(D, D)
+        # `overlap` directions of the target are shared with the source
+        Pt = numpy.linalg.qr(numpy.hstack((numpy.dot(Ps[:, :overlap], orthonormal(overlap, overlap)),
+                                           numpy.random.normal(0, 1, size=(D, dim - overlap)))))[0]
+        L = gfk_trainer._train_gfk(Ps, Pt)
+        assert numpy.allclose(numpy.dot(L, L.T), _gfk_integral(Ps, Pt), atol=1e-8)
+
+
+def test_znorm():
+    """
+
+    Testing the z-normalization on features with a large offset
+    """
+    import numpy
+    numpy.random.seed(10)
+
+    data = numpy.column_stack((1e8 + numpy.random.normal(0, 1, size=1000), numpy.full(1000, 1e8), numpy.random.normal(0, 1, size=1000)))
+    reference = numpy.std(data, axis=0)
+
+    gfk_trainer = GFKTrainer()
+    normalized, mu, std = gfk_trainer._znorm(data.copy())
+
+    assert numpy.allclose(std[[0, 2]], reference[[0, 2]])
+    # constant features get the floor value
+    assert std[1] == gfk_trainer.eps
+    assert numpy.allclose(normalized[:, 1], 0)
+
+
+def _subspace_distance(A, B):
+    """
+    Largest principal angle between the column spaces of A and B (orthonormal)
+    """
+    import numpy
+    return numpy.arccos(numpy.clip(numpy.linalg.svd(numpy.dot(A.T, B), compute_uv=False).min(), -1, 1))